@@ -1,14 +1,84 @@
 from datetime import datetime
 from typing import Union
 
+import numpy as np
 import pandas as pd
 
-from tfl_data.db import DatabaseReader, get_sqlite_reader
+from tfl_data.db import DatabaseReader, get_sqlite_reader, STATUS_DELIMITER, PLANNED_CLOSED_STATUSES, \
+    SUSPENDED_STATUSES, DELAYED_STATUSES, DISRUPTED_STATUSES
+
+# The status groups are defined in `db` (which needs them to set the status flags) but are also part of this module's
+# interface.
+__all__ = [
+    "PLANNED_CLOSED_STATUSES",
+    "SUSPENDED_STATUSES",
+    "DELAYED_STATUSES",
+    "DISRUPTED_STATUSES",
+    "SERVICE_CLOSED_STATUSES",
+    "status_flags",
+    "has_any_status",
+    "flag_statuses",
+    "count_disruptions",
+    "summarize_tube_line",
+    "get_tube_summary"
+]
+
+# Statuses indicating that a line is closed as scheduled, ie, outside of its normal service hours. These are not
+# disruptions, so are not flagged by the database.
+SERVICE_CLOSED_STATUSES = {'Service Closed'}
+
+
+def status_flags(statuses: pd.Series) -> pd.DataFrame:
+    """Convert a Series of delimited status strings (like the `statuses` column returned by
+    `DatabaseReader.get_line_statuses`) to a boolean DataFrame with the same index and one column for each status,
+    indicating whether that status was in effect. Unplanned and planned disruptions are already flagged by the
+    database, so this is for analysing other statuses (eg, "Service Closed" or "Special Service").
+
+    The strings are split in a single pass, and only once for each distinct combination of statuses.
+    """
+    statuses = statuses.astype('category')
+    combinations = pd.Series(statuses.cat.categories).str.split(STATUS_DELIMITER).explode()
+    codes, names = pd.factorize(combinations, sort=True)
+    # Build the matrix of which statuses appear in each combination directly, by setting one element for each
+    # (combination, status) pair, and then expand it to one row per observation. The matrix has an extra all-False
+    # last row, which is where the code -1 used for missing values points.
+    presence = np.zeros((len(statuses.cat.categories) + 1, len(names)), dtype=bool)
+    presence[combinations.index.to_numpy(), codes] = True
+    return pd.DataFrame(presence[statuses.cat.codes.to_numpy()], index=statuses.index, columns=names)
+
+
+def has_any_status(flags: pd.DataFrame, statuses: set[str]) -> pd.Series:
+    """Given a DataFrame returned by `status_flags`, return a boolean Series indicating which rows have any of the
+    given statuses.
+    """
+    columns = flags.columns.intersection(list(statuses))
+    return pd.Series(flags[columns].to_numpy().any(axis=1), index=flags.index)
+
+
+def flag_statuses(df: pd.DataFrame, column: str, statuses: set[str]) -> pd.DataFrame:
+    """Add a boolean column named `column` to a DataFrame returned by `DatabaseReader.get_line_statuses`, indicating
+    which observations have any of the given statuses.
+    """
+    categorical = df['statuses'].astype('category')
+    # Only test each distinct combination of statuses, and then look up the result for each observation by its code.
+    # The extra False at the end is selected by the code -1 used for missing values.
+    flags = status_flags(pd.Series(categorical.cat.categories))
+    matches = np.append(has_any_status(flags, statuses).to_numpy(), False)
+    df[column] = matches[categorical.cat.codes.to_numpy()]
+    return df
+
+
+def count_disruptions(df: pd.DataFrame) -> pd.DataFrame:
+    """Count the observations, the observations with unplanned and planned disruptions, and the observations where
+    the line was closed as scheduled, for each line in a DataFrame returned by `DatabaseReader.get_line_statuses`.
+    """
+    return flag_statuses(df, 'service_closed', SERVICE_CLOSED_STATUSES).groupby('line', observed=True).agg(
+        total_count=('statuses', 'size'),
+        unplanned_disruption_count=('unplanned_disruption', 'sum'),
+        planned_disruption_count=('planned_disruption', 'sum'),
+        service_closed_count=('service_closed', 'sum')
+    )
 
-PLANNED_CLOSED_STATUSES = {'Part Closure', 'Planned Closure'}
-SUSPENDED_STATUSES = {'Suspended', 'Part Suspended'}
-DELAYED_STATUSES = {'Minor Delays', 'Severe Delays'}
-DISRUPTED_STATUSES = SUSPENDED_STATUSES | DELAYED_STATUSES
 
 def summarize_tube_line(dr: DatabaseReader, line: str) -> dict[str, Union[str, int]]:
 
@@ -16,10 +86,17 @@ def summarize_tube_line(dr: DatabaseReader, line: str) -> dict[str, Union[str, i
     mode = "tube"
     data = {
         'line': line,
-        'total_count': dr.count_observations(modes={mode}, lines={line}),
-        'unplanned_disruption_count': dr.count_observations(modes={mode}, lines={line}, statuses=DISRUPTED_STATUSES),
-        'planned_disruption_count': dr.count_observations(modes={mode}, lines={line}, statuses=PLANNED_CLOSED_STATUSES)
+        'total_count': 0,
+        'unplanned_disruption_count': 0,
+        'planned_disruption_count': 0,
+        'service_closed_count': 0
     }
+    for df in dr.iter_line_statuses(modes={mode}, lines={line}):
+        df = flag_statuses(df, 'service_closed', SERVICE_CLOSED_STATUSES)
+        data['total_count'] += len(df)
+        data['unplanned_disruption_count'] += int(df['unplanned_disruption'].sum())
+        data['planned_disruption_count'] += int(df['planned_disruption'].sum())
+        data['service_closed_count'] += int(df['service_closed'].sum())
     end = datetime.now()
     duration = end - start
     print(f"Summarised {mode}/{line} in {duration}")
@@ -30,11 +107,13 @@ def get_tube_summary(dr: DatabaseReader) -> pd.DataFrame:
     """Return a DataFrame summarising the line status statistics for each tube line."""
 
     with dr:
-        data = [summarize_tube_line(dr, line) for line in dr.get_lines('tube')]
-    column_names = list(data[0])
-    df = pd.DataFrame(data, columns=column_names)
+        # Count each chunk of observations as it is read and then combine the counts, so that not all observations
+        # need to be held in memory at once.
+        counts = [count_disruptions(df) for df in dr.iter_line_statuses(modes={'tube'})]
+    df = pd.concat(counts).groupby(level='line', observed=True).sum().reset_index()
     df['unplanned_disruption_pct'] = 100 * (df['unplanned_disruption_count'] / df['total_count'])
     df['planned_disruption_pct'] = 100 * (df['planned_disruption_count'] / df['total_count'])
+    df['service_closed_pct'] = 100 * (df['service_closed_count'] / df['total_count'])
     return df
 
 
@@ -1,12 +1,15 @@
 import sys
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from functools import cache, cached_property
 from types import TracebackType
-from typing import Type, Optional, Any, Sequence
+from typing import Type, Optional, Any, Sequence, Iterable, Generator
 
+import numpy as np
 import pandas as pd
 from sqlalchemy import Table, MetaData, Column, DateTime, String, Integer, ForeignKey, Engine, Connection, \
-    insert, create_engine, UniqueConstraint, select, Select, Row, text
+    insert, create_engine, UniqueConstraint, select, Select, Row, text, func, Index, event, inspect, \
+    exists, type_coerce
 from sqlalchemy.sql.functions import count
 
 from tfl_data.parse import DataParser
@@ -18,6 +21,22 @@ MODES = ["bus", "national-rail", "tube", "river-bus", "dlr", "cable-car", "overg
 STATUSES = ["Good Service", "Minor Delays", "Severe Delays", "Special Service", "Reduced Service", "No Service",
             "Suspended", "Part Suspended", "Service Closed", "Planned Closure", "Part Closure", "Bus Service"]
 
+# The separator used when the statuses for a single observation are combined into a single string.
+STATUS_DELIMITER = ";"
+
+# Statuses indicating different kinds of disruption to service.
+PLANNED_CLOSED_STATUSES = {"Part Closure", "Planned Closure"}
+SUSPENDED_STATUSES = {"Suspended", "Part Suspended"}
+DELAYED_STATUSES = {"Minor Delays", "Severe Delays"}
+DISRUPTED_STATUSES = SUSPENDED_STATUSES | DELAYED_STATUSES
+
+# Bit flags stored with each line status indicating the kind of disruption (if any) it represents, so that queries can
+# filter on them with a single integer comparison rather than comparing against a list of statuses.
+DELAYED_FLAG = 1
+SUSPENDED_FLAG = 2
+PLANNED_CLOSED_FLAG = 4
+DISRUPTED_FLAGS = DELAYED_FLAG | SUSPENDED_FLAG
+
 # Schema metadata
 
 metadata = MetaData()
@@ -33,7 +52,8 @@ line_table = Table(
 status_table = Table(
     "status",
     metadata,
-    Column("description", String, primary_key=True)
+    Column("id", Integer, primary_key=True),
+    Column("description", String, nullable=False, unique=True)
 )
 
 line_observation_table = Table(
@@ -43,6 +63,9 @@ line_observation_table = Table(
     Column("timestamp", DateTime, nullable=False),
     Column("mode", String, ForeignKey("mode.name"), nullable=False),
     Column("line", String, nullable=False),
+    # SQLite backs this constraint with an index on (timestamp, mode, line), which also serves queries filtering on a
+    # range of timestamps. Timestamps are stored as ISO-8601 strings, which sort chronologically, so this only works as
+    # long as filters compare the column directly rather than wrapping it in a function like `datetime()`.
     UniqueConstraint("timestamp", "mode", "line")
 )
 
@@ -59,7 +82,8 @@ line_status_table = Table(
     metadata,
     Column("id", Integer, autoincrement=True, primary_key=True),
     Column("parent", Integer, ForeignKey("line_observation.id"), nullable=False),
-    Column("description", String, ForeignKey("status.description"), nullable=False),
+    Column("status_id", Integer, ForeignKey("status.id"), nullable=False),
+    Column("flags", Integer, nullable=False),
     Column("severity", Integer, nullable=False),
     Column("reason", String),
     Column("disruption_category", String),
@@ -67,6 +91,28 @@ line_status_table = Table(
     Column("disruption_additional_info", String)
 )
 
+# Almost every query filters observations by mode and line (and often timestamp), and joins statuses to their parent
+# observation while filtering by status or flags, so index those columns in that order.
+Index("ix_obs_mode_line_ts", line_observation_table.c.mode, line_observation_table.c.line,
+      line_observation_table.c.timestamp)
+Index("ix_status_parent_status", line_status_table.c.parent, line_status_table.c.status_id, line_status_table.c.flags)
+
+# PRAGMAs to run on each new SQLite connection, to reduce the cost of disk I/O.
+SQLITE_PRAGMAS = [
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=30000000000"
+]
+
+
+@cache
+def get_status_flags(description: str) -> int:
+    """Get the bit flags describing the kind of disruption represented by the given status description."""
+    return ((DELAYED_FLAG if description in DELAYED_STATUSES else 0)
+            | (SUSPENDED_FLAG if description in SUSPENDED_STATUSES else 0)
+            | (PLANNED_CLOSED_FLAG if description in PLANNED_CLOSED_STATUSES else 0))
+
 
 @dataclass
 class DateRange:
@@ -89,6 +135,15 @@ class DateRange:
         return cls(datetime(y, 1, 1), datetime(y + 1, 1, 1))
 
 
+def _to_categories(df: pd.DataFrame, *columns: str) -> pd.DataFrame:
+    """Convert the given columns of a DataFrame, which contain a small number of frequently repeated strings, to the
+    `category` dtype.
+    """
+    for c in columns:
+        df[c] = df[c].astype("category")
+    return df
+
+
 class _DatabaseManager:
     """Base class for classes that interact with the database in some way."""
 
@@ -103,6 +158,13 @@ class _DatabaseManager:
     def __exit__(self, exc_type: Type[Exception], exc_val: Exception, exc_tb: TracebackType):
         self.conn.close()
         self.conn = None
+        # Tables may be created by others before this manager connects again.
+        self.__dict__.pop("table_names", None)
+
+    @cached_property
+    def table_names(self) -> set[str]:
+        """The names of the tables in the database. Looked up on first access for each connection only."""
+        return set(inspect(self.conn).get_table_names())
 
 
 class DatabaseWriter(_DatabaseManager):
@@ -111,37 +173,103 @@ class DatabaseWriter(_DatabaseManager):
     def __init__(self, engine: Engine):
         super().__init__(engine)
         self._lines_cache: dict[str, set[str]] = {}
+        # Maps status descriptions to the integer codes stored in the `line_status` table.
+        self._status_ids: dict[str, int] = {}
+        # Build each statement once and execute it with bound parameters, so SQLAlchemy only compiles it once.
+        self._insert_mode = insert(mode_table).prefix_with("OR IGNORE")
+        self._insert_line = insert(line_table).prefix_with("OR IGNORE")
+        self._insert_observation = insert(line_observation_table)
+        self._insert_observations = self._insert_observation.returning(
+            line_observation_table.c.id,
+            sort_by_parameter_order=True
+        )
+        self._insert_status = insert(line_status_table)
+        self._insert_status_description = insert(status_table)
+
+    def __enter__(self):
+        super().__enter__()
+        self._load_lines_cache()
+        self._load_status_ids()
+        return self
+
+    def _load_lines_cache(self):
+        """Populate the cache of known modes and lines from the database, if the tables exist."""
+        self._lines_cache = {}
+        if line_table.name in self.table_names:
+            for mode, line in self.conn.execute(select(line_table.c.mode, line_table.c.line)):
+                self._lines_cache.setdefault(mode, set()).add(line)
+
+    def _load_status_ids(self):
+        """Populate the cache of status codes from the `status` table, if it exists."""
+        self._status_ids = {}
+        if status_table.name in self.table_names:
+            for status_id, description in self.conn.execute(select(status_table.c.id, status_table.c.description)):
+                self._status_ids[description] = status_id
 
     def create_tables(self):
+        """Create any tables that do not already exist, and populate the `status` table with the known statuses."""
         metadata.create_all(self.conn)
+        # The cached table names are now out of date.
+        self.__dict__.pop("table_names", None)
+        self.conn.execute(
+            insert(status_table).prefix_with("OR IGNORE"),
+            [{"id": i, "description": d} for i, d in enumerate(STATUSES, 1)]
+        )
+        self._load_status_ids()
+
+    def analyze(self):
+        """Gather statistics about the tables and indexes so that the query planner can make use of them. Should be
+        called after adding a large amount of data.
+        """
+        self.conn.execute(text("ANALYZE"))
+        self.conn.commit()
 
     def add_mode_line(self, mode: str, line: str):
         """Add a mode and line to the appropriate tables."""
-        if mode not in self._lines_cache:
-            self.conn.execute(insert(mode_table).values(name=mode))
-            self.conn.execute(insert(line_table).values(mode=mode, line=line))
-            self._lines_cache[mode] = {line}
-        elif line not in self._lines_cache[mode]:
-            self.conn.execute(insert(line_table).values(mode=mode, line=line))
-            self._lines_cache[mode].add(line)
+        self.add_mode_lines([(mode, line)])
+
+    def add_mode_lines(self, mode_lines: Iterable[tuple[str, str]]):
+        """Add any of the given (mode, line) pairs that are not already known to the appropriate tables, using a
+        single `INSERT OR IGNORE` for each table.
+        """
+        new_lines = {(m, l) for m, l in mode_lines if l not in self._lines_cache.get(m, ())}
+        if not new_lines:
+            return
+        new_modes = {m for m, _ in new_lines if m not in self._lines_cache}
+        if new_modes:
+            self.conn.execute(self._insert_mode, [{"name": m} for m in new_modes])
+        self.conn.execute(self._insert_line, [{"mode": m, "line": l} for m, l in new_lines])
+        for m, l in new_lines:
+            self._lines_cache.setdefault(m, set()).add(l)
+
+    def _status_id(self, description: str) -> int:
+        """Get the code for the given status description, adding it to the `status` table if it is not known."""
+        status_id = self._status_ids.get(description)
+        if status_id is None:
+            result = self.conn.execute(self._insert_status_description, {"description": description})
+            status_id = self._status_ids[description] = result.inserted_primary_key[0]
+        return status_id
+
+    def _line_status_row(self, parent_id: int, status: dict[str, Any]) -> dict[str, Any]:
+        """Convert a single status dict to the values to be inserted into the `line_status` table."""
+        # This is called for every status that is added, so bind the lookups to locals.
+        get = status.get
+        disruption_get = (get("disruption") or {}).get
+        description = get("statusSeverityDescription")
+        return {
+            "parent": parent_id,
+            "status_id": self._status_id(description),
+            "flags": get_status_flags(description),
+            "severity": get("statusSeverity"),
+            "reason": get("reason"),
+            "disruption_category": disruption_get("category"),
+            "disruption_description": disruption_get("description"),
+            "disruption_additional_info": disruption_get("additionalInfo")
+        }
 
     def add_line_status(self, parent_id: int, status: dict[str, Any], commit: bool = False):
         """Add a single line status to the database."""
-
-        disruption = status.get("disruption", {})
-        disruption_category = disruption.get("category")
-        disruption_description = disruption.get("description")
-        disruption_additional_info = disruption.get("additionalInfo")
-
-        self.conn.execute(insert(line_status_table).values(
-            parent=parent_id,
-            description=status.get("statusSeverityDescription"),
-            severity=status.get("statusSeverity"),
-            reason=status.get("reason"),
-            disruption_category=disruption_category,
-            disruption_description=disruption_description,
-            disruption_additional_info=disruption_additional_info
-        ))
+        self.conn.execute(self._insert_status, self._line_status_row(parent_id, status))
         if commit:
             self.conn.commit()
 
@@ -151,11 +279,11 @@ class DatabaseWriter(_DatabaseManager):
         mode_name = line["modeName"]
         line_name = line["name"]
         self.add_mode_line(mode_name, line_name)
-        result = self.conn.execute(insert(line_observation_table).values(
-            timestamp=timestamp,
-            mode=mode_name,
-            line=line_name
-        ))
+        result = self.conn.execute(self._insert_observation, {
+            "timestamp": timestamp,
+            "mode": mode_name,
+            "line": line_name
+        })
         pk = result.inserted_primary_key[0]
         for s in line["lineStatuses"]:
             self.add_line_status(pk, s)
@@ -165,22 +293,37 @@ class DatabaseWriter(_DatabaseManager):
         return count
 
     def add_from_dict(self, dt: datetime, data: list[dict[str, Any]], commit: bool = False) -> int:
-        """Add all line statuses from a dict parsed from a single file."""
-        count = 0
-        for line in data:
-            count += self.add_line_observation(dt, line)
+        """Add all line statuses from a dict parsed from a single file. The observations and statuses are each added
+        using a single multi-row insert. Returns the number of statuses added.
+        """
+        if not data:
+            return 0
+        self.add_mode_lines((line["modeName"], line["name"]) for line in data)
+        result = self.conn.execute(
+            self._insert_observations,
+            [{"timestamp": dt, "mode": line["modeName"], "line": line["name"]} for line in data]
+        )
+        status_rows = [
+            self._line_status_row(pk, s)
+            for pk, line in zip(result.scalars(), data)
+            for s in line["lineStatuses"]
+        ]
+        if status_rows:
+            self.conn.execute(self._insert_status, status_rows)
         if commit:
             self.conn.commit()
-        return count
+        return len(status_rows)
 
     def add_from_data(self, data_dir: str, commit: bool = False) -> int:
-        """Add all line statuses from JSON files to database."""
+        """Add all line statuses from JSON files to database. If `commit` is true, the data from each file is committed
+        as a single transaction.
+        """
         count = 0
         parser = DataParser(data_dir)
         for dt, d in parser.walk_category("lines"):
             if d is None:
                 continue
-            count += self.add_from_dict(dt, d)
+            count += self.add_from_dict(dt, d, commit)
         if commit:
             self.conn.commit()
         return count
@@ -194,10 +337,37 @@ class DatabaseReader(_DatabaseManager):
         )]
 
     def observations_df(self, mode: str) -> pd.DataFrame:
-        return pd.read_sql(select(line_observation_table).where(line_observation_table.c.mode == mode), self.conn)
+        return _to_categories(
+            pd.read_sql(select(line_observation_table).where(line_observation_table.c.mode == mode), self.conn),
+            "mode", "line"
+        )
 
     def statuses_df(self) -> pd.DataFrame:
-        return pd.read_sql(select(line_status_table), self.conn)
+        return _to_categories(
+            pd.read_sql(
+                select(line_status_table, status_table.c.description).join_from(line_status_table, status_table),
+                self.conn
+            ),
+            "description"
+        )
+
+    @staticmethod
+    def _filter_observations(
+            query: Select,
+            date_range: Optional[DateRange] = None,
+            modes: Optional[set[str]] = None,
+            lines: Optional[set[str]] = None
+    ) -> Select:
+        """Restrict a query on the `line_observation` table to observations meeting the specified criteria."""
+        if date_range is not None:
+            query = (query
+                     .where(line_observation_table.c.timestamp >= date_range.start)
+                     .where(line_observation_table.c.timestamp < date_range.end))
+        if modes is not None:
+            query = query.where(line_observation_table.c.mode.in_(modes))
+        if lines is not None:
+            query = query.where(line_observation_table.c.line.in_(lines))
+        return query
 
     def query_observations(
             self,
@@ -205,7 +375,8 @@ class DatabaseReader(_DatabaseManager):
             date_range: Optional[DateRange] = None,
             modes: Optional[set[str]] = None,
             lines: Optional[set[str]] = None,
-            statuses: Optional[set[str]] = None
+            statuses: Optional[set[str]] = None,
+            flags: Optional[int] = None
     ) -> Select:
         """Generate a query to that will return all observations meeting the specified criteria.
 
@@ -214,60 +385,168 @@ class DatabaseReader(_DatabaseManager):
         :param modes: Filter to observations relating to any of the given modes.
         :param lines: Filter to observations relating to any of the given lines.
         :param statuses: Filter to observations having any of the given statuses.
+        :param flags: Filter to observations having any status with any of the given bit flags (eg, `DISRUPTED_FLAGS`).
         """
-        query = (select(to_select).select_from(
-            line_observation_table
-        ).join_from(
-            line_observation_table,
-            line_status_table
-        ))
+        query = select(to_select).select_from(line_observation_table)
 
-        if date_range is not None:
-            query = (query
-                     .where(line_observation_table.c.timestamp >= date_range.start)
-                     .where(line_observation_table.c.timestamp < date_range.end))
-        if modes is not None:
-            query = query.where(line_observation_table.c.mode.in_(modes))
-        if lines is not None:
-            query = query.where(line_observation_table.c.line.in_(lines))
+        query = self._filter_observations(query, date_range, modes, lines)
+        # An observation can have several statuses, so test for a matching status with EXISTS rather than joining,
+        # which would return (and count) each observation once for each matching status.
         if statuses is not None:
-            query = query.where(line_status_table.c.description.in_(statuses))
-
-        return query.distinct()
+            query = query.where(exists().where(
+                line_status_table.c.parent == line_observation_table.c.id
+            ).where(
+                # Look up the codes for the statuses in the same query, so that the comparison is still between
+                # integers but always reflects the current contents of the `status` table.
+                line_status_table.c.status_id.in_(
+                    select(status_table.c.id).where(status_table.c.description.in_(statuses))
+                )
+            ))
+        if flags is not None:
+            query = query.where(exists().where(
+                line_status_table.c.parent == line_observation_table.c.id
+            ).where(
+                line_status_table.c.flags.op("&")(flags) != 0
+            ))
+
+        return query
 
     def get_observations(
             self,
             date_range: Optional[DateRange] = None,
             modes: Optional[set[str]] = None,
             lines: Optional[set[str]] = None,
-            statuses: Optional[set[str]] = None
+            statuses: Optional[set[str]] = None,
+            flags: Optional[int] = None
     ) -> Sequence[Row]:
         """Get all observations meeting the specified criteria. See docs for `query_observation` method."""
-        return self.conn.execute(self.query_observations("*", date_range, modes, lines, statuses)).all()
+        return self.conn.execute(self.query_observations("*", date_range, modes, lines, statuses, flags)).all()
 
     def count_observations(
             self,
             date_range: Optional[DateRange] = None,
             modes: Optional[set[str]] = None,
             lines: Optional[set[str]] = None,
-            statuses: Optional[set[str]] = None
+            statuses: Optional[set[str]] = None,
+            flags: Optional[int] = None
     ) -> int:
         """Count how many observations meet the specified criteria. See docs for `query_observation` method."""
-        return self.conn.execute(self.query_observations(count(), date_range, modes, lines, statuses)).one()[0]
+        return self.conn.execute(self.query_observations(count(), date_range, modes, lines, statuses, flags)).one()[0]
+
+    @classmethod
+    def _query_line_statuses(
+            cls,
+            date_range: Optional[DateRange] = None,
+            modes: Optional[set[str]] = None,
+            lines: Optional[set[str]] = None
+    ) -> Select:
+        query = (select(
+            # Fetch the timestamps as stored, rather than having SQLAlchemy convert each one to a datetime, so that
+            # pandas can parse the whole column at once.
+            type_coerce(line_observation_table.c.timestamp, String).label("timestamp"),
+            line_observation_table.c.mode,
+            line_observation_table.c.line,
+            func.group_concat(status_table.c.description, STATUS_DELIMITER).label("statuses"),
+            # Classify each observation using the flags stored with its statuses, which are read from the same covering
+            # index as the join, rather than by matching the descriptions.
+            func.max(line_status_table.c.flags.op("&")(DISRUPTED_FLAGS) != 0).label("unplanned_disruption"),
+            func.max(line_status_table.c.flags.op("&")(PLANNED_CLOSED_FLAG) != 0).label("planned_disruption")
+        ).join_from(
+            line_observation_table,
+            line_status_table
+        ).join(
+            status_table
+        ))
+        query = cls._filter_observations(query, date_range, modes, lines)
+        # (mode, line, timestamp) is unique, so this still gives one row per observation, but unlike grouping by id it
+        # lets SQLite read the observations in order from ix_obs_mode_line_ts rather than scanning the whole table.
+        return query.group_by(
+            line_observation_table.c.mode,
+            line_observation_table.c.line,
+            line_observation_table.c.timestamp
+        )
+
+    @staticmethod
+    def _line_statuses_df(rows: Sequence[Row]) -> pd.DataFrame:
+        # Build the DataFrame column by column rather than row by row, so that pandas does not have to infer the type
+        # of each column from the individual rows. Each combination of statuses is repeated many times, like the mode
+        # and line, and string methods on a categorical Series only need to be evaluated once per category.
+        timestamps, modes, lines, statuses, unplanned, planned = zip(*rows) if rows else ((),) * 6
+        return pd.DataFrame({
+            "timestamp": pd.to_datetime(list(timestamps), format="ISO8601"),
+            "mode": pd.Categorical(modes),
+            "line": pd.Categorical(lines),
+            "statuses": pd.Categorical(statuses),
+            "unplanned_disruption": np.array(unplanned, dtype=bool),
+            "planned_disruption": np.array(planned, dtype=bool)
+        })
+
+    def get_line_statuses(
+            self,
+            date_range: Optional[DateRange] = None,
+            modes: Optional[set[str]] = None,
+            lines: Optional[set[str]] = None
+    ) -> pd.DataFrame:
+        """Get a DataFrame with one row for each observation meeting the specified criteria. The `statuses` column
+        contains the descriptions of all statuses in effect at the time of the observation, separated by
+        `STATUS_DELIMITER`, so that it can be searched using pandas' vectorized string methods. The boolean
+        `unplanned_disruption` and `planned_disruption` columns indicate whether any of those statuses has
+        `DISRUPTED_FLAGS` or `PLANNED_CLOSED_FLAG` set, respectively.
+
+        See docs for `query_observation` method.
+        """
+        rows = self.conn.execute(self._query_line_statuses(date_range, modes, lines)).all()
+        return self._line_statuses_df(rows)
+
+    def iter_line_statuses(
+            self,
+            date_range: Optional[DateRange] = None,
+            modes: Optional[set[str]] = None,
+            lines: Optional[set[str]] = None,
+            chunksize: int = 100_000
+    ) -> Generator[pd.DataFrame, None, None]:
+        """Like `get_line_statuses`, but yield the results as a series of DataFrames of at most `chunksize` rows each,
+        fetching each chunk from the database only when it is needed, so that memory use does not grow with the number
+        of observations. As with `pd.read_sql`, a single empty DataFrame is yielded if no observations match.
+        """
+        query = self._query_line_statuses(date_range, modes, lines)
+        # Pass the option for this statement only; `Connection.execution_options` would change the connection itself.
+        result = self.conn.execute(query, execution_options={"yield_per": chunksize})
+        empty = True
+        for rows in result.partitions():
+            empty = False
+            yield self._line_statuses_df(rows)
+        if empty:
+            yield self._line_statuses_df([])
+
+
+def _set_sqlite_pragmas(dbapi_conn: Any, connection_record: Any):
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+
+def create_sqlite_engine(db_fpath: str) -> Engine:
+    """Create an engine connecting to the SQLite database at the given path, with `SQLITE_PRAGMAS` applied to each
+    connection.
+    """
+    engine = create_engine(f"sqlite:///{db_fpath}")
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
 
 
 def get_sqlite_reader(db_fpath: str) -> DatabaseReader:
-    engine = create_engine(f"sqlite:///{db_fpath}")
-    return DatabaseReader(engine)
+    return DatabaseReader(create_sqlite_engine(db_fpath))
 
 
 def create_database(data_dir: str, db_fpath: str):
-    engine = create_engine(f"sqlite:///{db_fpath}")
-    dw = DatabaseWriter(engine)
+    dw = DatabaseWriter(create_sqlite_engine(db_fpath))
     count = 0
     with dw:
         dw.create_tables()
         count += dw.add_from_data(data_dir, commit=True)
+        dw.analyze()
     print(f"Added {count} line statuses.")
 
 
@@ -1,12 +1,20 @@
-import json
 import logging
 import os
 import tarfile
-import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
 from dataclasses import dataclass
 from datetime import datetime
 from typing import Optional, Generator, Any
 
+import pandas as pd
+
+try:
+    # orjson parses JSON considerably faster than the standard library, so use it if it is installed.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 def listdir(*args, **kwargs) -> list[str]:
     """Wrapper around os.listdir which sorts the results."""
@@ -19,31 +27,43 @@ class DataParser:
     def __init__(self, data_dir: str):
         self.data_dir = data_dir
 
-    def extract_data(self, fpath: str) -> Optional[dict]:
+    @staticmethod
+    def extract_data(fpath: str) -> Optional[dict]:
         """Extract and parse JSON data from gzip-compressed tar file.
 
         :param fpath: Path to tar file.
         :return: A dict containing the data from the file.
         """
         logging.info(f'Extracting data from {fpath}')
-        fname = os.path.basename(fpath)
-        json_fname = fname.rstrip('.tar.gz')
-        with tempfile.TemporaryDirectory() as tmpdir:
-            with tarfile.open(fpath) as tf:
-                tf.extractall(tmpdir)
-            extracted = os.path.join(tmpdir, json_fname)
-            if os.path.getsize(extracted) == 0:
+        with tarfile.open(fpath, 'r:gz') as tf:
+            member = next((m for m in tf if m.isfile()), None)
+            if member is None:
                 return None
-            with open(os.path.join(tmpdir, json_fname)) as jf:
-                return json.load(jf)
+            data = tf.extractfile(member).read()
+        if not data:
+            return None
+        return json_loads(data)
 
-    def walk_category(self, category: str) -> Generator[list[dict[str, Any]], None, None]:
+    def walk_category(
+            self,
+            category: str,
+            max_workers: Optional[int] = None
+    ) -> Generator[tuple[datetime, Optional[list[dict[str, Any]]]], None, None]:
         """Walk through all files in a particular data category, yielding for each file a tuple
         of a datetime object and a list containing the data for that date and time.
 
+        The files are extracted and parsed in parallel by a pool of worker processes, but are
+        yielded in order. Only about twice as many files as there are workers are submitted
+        ahead of the consumer, so parsed data does not pile up in memory if the consumer is
+        slower than the workers, and closing the generator early only waits for the files
+        that are currently being parsed.
+
         :param category: The category of data we want to inspect.
+        :param max_workers: The number of worker processes to use. Defaults to the number of CPUs.
         """
         root_dir = os.path.join(self.data_dir, category)
+        timestamps = []
+        fpaths = []
         for year in listdir(root_dir):
             year_dir = os.path.join(root_dir, year)
             for month in listdir(year_dir):
@@ -51,9 +71,24 @@ class DataParser:
                 for day in listdir(month_dir):
                     day_dir = os.path.join(month_dir, day)
                     for fname in listdir(day_dir):
-                        fpath = os.path.join(day_dir, fname)
                         hour = fname[11:13]
                         minute = fname[14:16]
-                        dt = datetime(int(year), int(month), int(day), int(hour), int(minute))
-                        data = self.extract_data(fpath)
-                        yield dt, data
+                        timestamps.append(f'{year}-{month}-{day} {hour}:{minute}')
+                        fpaths.append(os.path.join(day_dir, fname))
+        dts = pd.to_datetime(timestamps, format='%Y-%m-%d %H:%M').to_pydatetime()
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        window = 2 * max_workers
+        pending: deque[tuple[datetime, Future]] = deque()
+        executor = ProcessPoolExecutor(max_workers)
+        try:
+            for dt, fpath in zip(dts, fpaths):
+                pending.append((dt, executor.submit(self.extract_data, fpath)))
+                if len(pending) >= window:
+                    dt, future = pending.popleft()
+                    yield dt, future.result()
+            while pending:
+                dt, future = pending.popleft()
+                yield dt, future.result()
+        finally:
+            executor.shutdown(cancel_futures=True)